@@ -7,13 +7,21 @@ Fixes in this build
   instrument list instead of hand‑building it, so ✅/❌ works for stocks
   *and* weekly index options.
 • check_option() returns ❌ immediately when the symbol is missing.
-• Everything else (ΔCE/ΔPE, alert storage, Telegram) is unchanged.
+• Alerts are stored in SQLite (DATA_DIR/alerts.db) instead of alerts.json;
+  an existing alerts.json is imported once on first start.
+• ΔCE/ΔPE reads LTP and day‑open from one batched quote(); Telegram
+  messages are sent from a small background pool.
 """
 
 # ─── Std‑libs & 3rd‑party ────────────────────────────────────
-import os, json, datetime, logging, pathlib, requests
+import os, json, time, queue, atexit, bisect, pickle, datetime, functools, logging, pathlib, sqlite3, threading, requests
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request, render_template, redirect, url_for, session
 from kiteconnect import KiteConnect
+from kiteconnect.exceptions import TokenException
 
 # ─── Logging ────────────────────────────────────────────────
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"))
@@ -29,11 +37,22 @@ except ImportError:                # Python 3.8 on Render
 # ─── Constants ─────────────────────────────────────────────
 WIDTH_VOL   = 2          # ATM ±2 strikes for volume‑spike check
 WIDTH_DECAY = 1          # ATM ±1 strikes for ΔCE/ΔPE
-QUOTE_BATCH = 25         # Max symbols per kite.quote() call
+QUOTE_BATCH = 500        # Max symbols per kite.quote() call (Kite limit)
+ALERT_BATCH = 40         # Max alerts per executemany() flush
+ALERT_FLUSH = 0.5        # Seconds a queued alert may wait for its batch
+WEBHOOK_WORKERS = 4      # Threads processing queued webhooks
+WEBHOOK_BATCH = 20       # Max webhooks coalesced into one spot prefetch
+WEBHOOK_WAIT  = 0.1      # Seconds the dispatcher waits to fill a batch
+QUOTE_TTL   = 2          # Seconds a quote is reused across alerts
+HIST_WORKERS = 3         # Concurrent historical_data() calls
+HIST_RATE   = 3          # historical_data() requests per second (Kite limit)
+CANDLE_TTL  = 30         # Seconds a candle fetch is reused (the last bar is still forming)
+DEDUP_SECS  = 60         # Repeat alerts for a symbol within one bucket are dropped
 
 # ─── Paths ─────────────────────────────────────────────────
 DATA_DIR    = pathlib.Path(os.getenv("DATA_DIR", "."))
-ALERTS_FILE = DATA_DIR / "alerts.json"
+ALERTS_FILE = DATA_DIR / "alerts.json"      # legacy store, imported once
+DB_FILE     = DATA_DIR / "alerts.db"
 TOKEN_FILE  = DATA_DIR / "access_token.txt"
 
 # ─── Flask app & env‑vars ──────────────────────────────────
@@ -51,10 +70,16 @@ if not (TELEGRAM_TOKEN and TELEGRAM_CHAT_ID):
 # ───────────────────────────────────────────────────────────
 # Helpers
 # ───────────────────────────────────────────────────────────
+# Keep‑alive session: reuses the TLS connection to api.telegram.org
+_TG = requests.Session()
+_TG.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=10,
+                                  max_retries=Retry(total=2, backoff_factor=0.2)))
+_TG_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="telegram")
+
 def send_telegram(msg: str):
     """Fire‑and‑forget Telegram message."""
     try:
-        requests.post(
+        _TG.post(
             f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
             data={"chat_id": TELEGRAM_CHAT_ID, "text": msg, "parse_mode": "Markdown"},
             timeout=5,
@@ -62,114 +87,274 @@ def send_telegram(msg: str):
     except Exception:
         logging.warning("Telegram send failed")
 
+_TOK_CACHE, _TOK_MTIME = None, 0
+def access_token():
+    """Access token from TOKEN_FILE, re‑read only when its mtime changes."""
+    global _TOK_CACHE, _TOK_MTIME
+    try:
+        mtime = os.stat(TOKEN_FILE).st_mtime_ns
+    except FileNotFoundError:
+        _TOK_CACHE, _TOK_MTIME = None, 0
+        return None
+    if mtime != _TOK_MTIME:
+        _TOK_CACHE = TOKEN_FILE.read_text().strip()
+        _TOK_MTIME = mtime
+    return _TOK_CACHE
+
+_KITE_LOCAL = threading.local()
 def kite_session() -> KiteConnect:
-    kite = KiteConnect(api_key=KITE_API_KEY)
-    if TOKEN_FILE.exists():
-        kite.set_access_token(TOKEN_FILE.read_text().strip())
+    """Per‑thread KiteConnect client, rebuilt only when the token changes."""
+    token = access_token()
+    kite  = getattr(_KITE_LOCAL, "kite", None)
+    if kite is None or _KITE_LOCAL.token != token:
+        kite = KiteConnect(api_key=KITE_API_KEY)
+        if token:
+            kite.set_access_token(token)
+        _KITE_LOCAL.kite, _KITE_LOCAL.token = kite, token
     return kite
 
-_INSTR_CACHE, _CACHE_DATE = None, None
-def instruments():
-    """Daily‑cached list of NFO instruments."""
-    global _INSTR_CACHE, _CACHE_DATE
-    today = datetime.datetime.now(IST).date()
-    if _INSTR_CACHE is None or _CACHE_DATE != today:
-        _INSTR_CACHE = kite_session().instruments("NFO")
-        _CACHE_DATE  = today
-    return _INSTR_CACHE
+_REJECTED_TOKEN = None    # last token Kite refused; skip Kite until it changes
+def token_rejected() -> bool:
+    """True while TOKEN_FILE still holds the token Kite last rejected."""
+    return _REJECTED_TOKEN is not None and access_token() == _REJECTED_TOKEN
 
-def ltp_open_map(kite: KiteConnect, symbols: list[str]):
-    """Batch‑fetch {symbol: (ltp, open)} for up to QUOTE_BATCH symbols at a time."""
-    out = {}
-    for batch in (symbols[i:i+QUOTE_BATCH] for i in range(0, len(symbols), QUOTE_BATCH)):
+def _nfo_dump(today: datetime.date, force: bool = False):
+    """Today's NFO instrument dump, from DATA_DIR/nfo_YYYYMMDD.pkl when present
+    (*force* re‑downloads and rewrites the pickle)."""
+    path = DATA_DIR / f"nfo_{today:%Y%m%d}.pkl"
+    if path.exists() and not force:
         try:
-            q = kite.quote(batch)
-            for s, d in q.items():
-                out[s] = (d["last_price"], d["ohlc"]["open"])
+            return pickle.loads(path.read_bytes())
         except Exception:
-            logging.warning("kite.quote failed for %s", batch)
+            logging.warning("Corrupt %s, re‑fetching", path.name)
+    rows = kite_session().instruments("NFO")
+    tmp  = path.with_suffix(".tmp")
+    tmp.write_bytes(pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL))
+    os.replace(tmp, path)
+    for old in DATA_DIR.glob("nfo_*.pkl"):     # keep only today's dump
+        if old != path:
+            old.unlink(missing_ok=True)
+    return rows
+
+_INSTR_CACHE, _CACHE_DATE = None, None
+_INSTR_EXPIRIES = {}      # name → sorted expiries
+_INSTR_STRIKES  = {}      # (name, expiry) → sorted option strikes
+_INSTR_TSYM     = {}      # (name, expiry, strike, CE/PE) → trading‑symbol
+_INSTR_TOKEN    = {}      # trading‑symbol → instrument_token
+_INSTR_LOCK     = threading.Lock()
+def _refresh_instruments(force: bool = False):
+    """(Re)load the NFO dump once per IST day and build the lookup indexes;
+    *force* rebuilds even if today's dump is already loaded."""
+    global _INSTR_CACHE, _CACHE_DATE, _INSTR_EXPIRIES, _INSTR_STRIKES, _INSTR_TSYM, _INSTR_TOKEN
+    today = datetime.datetime.now(IST).date()
+    if not force and _INSTR_CACHE is not None and _CACHE_DATE == today:
+        return
+    with _INSTR_LOCK:             # one fetch even under concurrent webhooks
+        if not force and _INSTR_CACHE is not None and _CACHE_DATE == today:
+            return
+        rows     = _nfo_dump(today, force)
+        expiries = defaultdict(set)
+        strikes  = defaultdict(set)
+        tsym     = {}
+        tokens   = {}
+        for row in rows:
+            name, exp, typ = row["name"], row["expiry"], row["instrument_type"]
+            expiries[name].add(exp)
+            tokens[row["tradingsymbol"]] = row["instrument_token"]
+            if typ in ("CE", "PE"):
+                strikes[(name, exp)].add(row["strike"])
+                tsym[(name, exp, row["strike"], typ)] = row["tradingsymbol"]
+        _INSTR_EXPIRIES = {k: sorted(v) for k, v in expiries.items()}
+        _INSTR_STRIKES  = {k: sorted(v) for k, v in strikes.items()}
+        _INSTR_TSYM     = tsym
+        _INSTR_TOKEN    = tokens
+        _INSTR_CACHE, _CACHE_DATE = rows, today
+        _next_expiry.cache_clear()
+
+def _warm_instruments(force: bool = False):
+    """Build today's instrument indexes ahead of the first webhook."""
+    try:
+        _refresh_instruments(force)
+    except Exception:
+        logging.exception("Instrument warm‑up failed")
+
+def _schedule_warmup():
+    """Re‑warm every day at 08:45 IST, before the market opens."""
+    now = datetime.datetime.now(IST)
+    nxt = now.replace(hour=8, minute=45, second=0, microsecond=0)
+    if nxt <= now:
+        nxt += datetime.timedelta(days=1)
+    t = threading.Timer((nxt - now).total_seconds(),
+                        lambda: (_warm_instruments(force=True), _schedule_warmup()))
+    t.daemon = True
+    t.start()
+
+_QUOTE_CACHE = {}         # "EXCH:SYM" → (fetched_at, quote)
+def quotes(kite: KiteConnect, symbols: list[str]):
+    """{symbol: quote} in QUOTE_BATCH chunks, reusing quotes younger than QUOTE_TTL."""
+    now  = time.monotonic()
+    out, miss = {}, []
+    for s in symbols:
+        hit = _QUOTE_CACHE.get(s)
+        if hit and now - hit[0] < QUOTE_TTL:
+            out[s] = hit[1]
+        else:
+            miss.append(s)
+    if len(_QUOTE_CACHE) > 2048:          # drop stale entries, keep it bounded
+        for s, (ts, _) in list(_QUOTE_CACHE.items()):
+            if now - ts >= QUOTE_TTL:
+                _QUOTE_CACHE.pop(s, None)
+    for batch in (miss[i:i+QUOTE_BATCH] for i in range(0, len(miss), QUOTE_BATCH)):
+        for s, d in kite.quote(batch).items():
+            _QUOTE_CACHE[s] = (now, d)
+            out[s] = d
     return out
 
+def ltp_open_map(kite: KiteConnect, symbols: list[str]):
+    """Batch‑fetch {symbol: (ltp, open)}."""
+    try:
+        q = quotes(kite, symbols)
+    except Exception:
+        logging.warning("kite.quote failed for %s", symbols)
+        return {}
+    return {s: (d["last_price"], d["ohlc"]["open"]) for s, d in q.items()}
+
+def spot_quote(kite: KiteConnect, symbol: str):
+    """Quote for the underlying, shared by alerts within QUOTE_TTL."""
+    key = f"NSE:{symbol.upper()}"
+    return quotes(kite, [key])[key]
+
 # ─── Expiry / strike helpers ───────────────────────────────
 def next_expiry(scrip: str):
-    today = datetime.datetime.now(IST).date()
-    exps  = sorted({i["expiry"] for i in instruments()
-                    if i["name"] == scrip or i["tradingsymbol"].startswith(scrip)})
-    for d in exps:
-        if d >= today:
-            return d
-    return exps[-1]
+    return _next_expiry(scrip, datetime.datetime.now(IST).date())
+
+@functools.lru_cache(maxsize=256)
+def _next_expiry(scrip: str, today: datetime.date):
+    """Nearest expiry on/after *today*, memoised per (symbol, IST day)."""
+    _refresh_instruments()
+    exps  = _INSTR_EXPIRIES.get(scrip)
+    if exps is None:          # not an underlying name: prefix‑scan once per day
+        exps = _INSTR_EXPIRIES[scrip] = sorted(
+            {i["expiry"] for i in _INSTR_CACHE if i["tradingsymbol"].startswith(scrip)})
+    i = bisect.bisect_left(exps, today)
+    return exps[i] if i < len(exps) else exps[-1]
+
+def chain_strikes(name: str, expiry: datetime.date):
+    """Sorted option strikes listed for (name, expiry)."""
+    _refresh_instruments()
+    return _INSTR_STRIKES.get((name, expiry), [])
+
+def atm_strike(strikes: list[int], spot: float):
+    """Strike nearest to *spot* in the sorted *strikes* list."""
+    i = bisect.bisect_left(strikes, spot)
+    return min(strikes[max(0, i - 1): i + 1], key=lambda x: abs(x - spot))
 
 def strikes_window(strikes: list[int], atm: int, width: int):
     if not strikes:
         return []
-    idx = strikes.index(atm)
+    idx = bisect.bisect_left(strikes, atm)
     return strikes[max(0, idx - width): idx + width + 1]
 
 # ─── Option‑symbol helper (NEW) ────────────────────────────
 def option_symbol(name: str, strike: int, expiry: datetime.date, kind: str):
     """Return Zerodha trading‑symbol for (name, strike, expiry, PE/CE)."""
     typ = "PE" if kind == "PUT" else "CE"
-    for row in instruments():
-        if (row["name"] == name.upper() and row["instrument_type"] == typ
-                and row["strike"] == strike and row["expiry"] == expiry):
-            return row["tradingsymbol"]
-    return None
-
-# ─── ΔCE / ΔPE (unchanged) ─────────────────────────────────
-def compute_ce_pe_change(kite: KiteConnect, scrip: str):
+    _refresh_instruments()
+    return _INSTR_TSYM.get((name.upper(), expiry, strike, typ))
+
+# ─── ΔCE / ΔPE ────────────────────────────────────────────
+def compute_ce_pe_change(kite: KiteConnect, scrip: str, spot: float | None = None):
     base   = scrip.upper().replace("NSE:", "")
-    spot   = kite.ltp([f"NSE:{base}"])[f"NSE:{base}"]["last_price"]
+    if spot is None:                  # caller usually passes the spot it already has
+        spot = kite.ltp([f"NSE:{base}"])[f"NSE:{base}"]["last_price"]
     exp_dt = next_expiry(base)
 
-    chain  = [i for i in instruments()
-              if i["name"] == base and i["expiry"] == exp_dt
-                 and i["instrument_type"] in {"CE", "PE"}]
-    if not chain:
+    strikes = chain_strikes(base, exp_dt)
+    if not strikes:
         return 0.0, 0.0
 
-    strikes = sorted({i["strike"] for i in chain})
-    atm     = min(strikes, key=lambda x: abs(x - spot))
+    atm     = atm_strike(strikes, spot)
     window  = strikes_window(strikes, atm, WIDTH_DECAY)
 
-    sel_rows = [i for i in chain if i["strike"] in window]
-    data_raw = ltp_open_map(kite, [f"NFO:{i['tradingsymbol']}" for i in sel_rows])
+    sel_keys = [(f"NFO:{ts}", typ) for st in window for typ in ("CE", "PE")
+                if (ts := _INSTR_TSYM.get((base, exp_dt, st, typ)))]
+    data_raw = ltp_open_map(kite, [k for k, _ in sel_keys])
     if not data_raw:
         return 0.0, 0.0
 
     d_ce = d_pe = 0.0
-    for row in sel_rows:
-        key          = f"NFO:{row['tradingsymbol']}"
+    for key, typ in sel_keys:
         ltp, opn     = data_raw.get(key, (None, None))
         if ltp is None:
             continue
         diff = ltp - opn
-        if row["instrument_type"] == "CE":
+        if typ == "CE":
             d_ce += diff
         else:
             d_pe += diff
-    return round(d_ce, 2), round(d_pe, 2)
+    return d_ce, d_pe
 
 # ─── Volume‑spike check (uses option_symbol) ───────────────
+_HIST_POOL    = ThreadPoolExecutor(max_workers=HIST_WORKERS, thread_name_prefix="hist")
+_CANDLE_CACHE = {}        # (token, 5‑min bar) → (fetched_at, today's candles)
+_HIST_NEXT, _HIST_LOCK = 0.0, threading.Lock()
+def _hist_throttle():
+    """Space historical_data() calls 1/HIST_RATE s apart across all threads."""
+    global _HIST_NEXT
+    with _HIST_LOCK:
+        now        = time.monotonic()
+        wait       = _HIST_NEXT - now
+        _HIST_NEXT = max(now, _HIST_NEXT) + 1 / HIST_RATE
+    if wait > 0:
+        time.sleep(wait)
+
+def candles_5min(kite: KiteConnect, token: int):
+    """Today's 5‑min candles for *token*. The last bar is still forming, so a
+    cached response is reused for at most CANDLE_TTL seconds."""
+    bar = int(time.time() // 300)     # IST bars align with epoch 5‑min slots
+    hit = _CANDLE_CACHE.get((token, bar))
+    if hit and time.monotonic() - hit[0] < CANDLE_TTL:
+        return hit[1]
+    end   = datetime.datetime.now(IST)
+    start = datetime.datetime.combine(end.date(), datetime.time(9, 15, tzinfo=IST))
+    _hist_throttle()
+    cds   = kite.historical_data(token, start, end, "5minute")
+    for key in [k for k in list(_CANDLE_CACHE) if k[1] != bar]:   # snapshot: other threads write
+        _CANDLE_CACHE.pop(key, None)
+    _CANDLE_CACHE[(token, bar)] = (time.monotonic(), cds)
+    return cds
+
+def _check_leg(job: tuple):
+    """check_option() for one pooled leg; a failed fetch marks only that leg ⚠️
+    (not ❌, which is a real verdict). A rejected token still fails the alert."""
+    try:
+        return check_option(*job)
+    except TokenException:
+        raise
+    except Exception:
+        logging.warning("Candle check failed for %s", job[0], exc_info=True)
+        return "⚠️"
+
 def check_option(tsym: str | None, is_put: bool):
     """Return ✅/❌ for the latest 5‑min candle volume & colour rule."""
     if not tsym:                      # symbol missing
         return "❌"
 
-    token = next((i["instrument_token"] for i in instruments()
-                  if i["tradingsymbol"] == tsym), None)
+    _refresh_instruments()
+    token = _INSTR_TOKEN.get(tsym)
     if not token:
         return "❌"
 
-    kite   = kite_session()
-    end    = datetime.datetime.now(IST)
-    start  = datetime.datetime.combine(end.date(), datetime.time(9, 15, tzinfo=IST))
-    cds    = kite.historical_data(token, start, end, "5minute")
+    cds    = candles_5min(kite_session(), token)
     if not cds:
         return "❌"
 
+    max_v = 0
+    for c in cds:                     # single pass, no volume list
+        if c["volume"] > max_v:
+            max_v = c["volume"]
     latest = cds[-1]
-    if latest["volume"] != max(c["volume"] for c in cds):
+    if latest["volume"] != max_v:
         return "❌"
 
     green  = latest["close"] > latest["open"]
@@ -180,24 +365,98 @@ def check_option(tsym: str | None, is_put: bool):
 def today_str():
     return datetime.datetime.now(IST).strftime("%Y-%m-%d")
 
-if not ALERTS_FILE.exists():
-    ALERTS_FILE.write_text("[]")
-
-alerts = [a for a in json.loads(ALERTS_FILE.read_text())
-          if a.get("time", "").startswith(today_str())]
+ALERT_COLS = ("symbol", "time", "ltp", "move", "ce_chg", "pe_chg",
+              "put_result", "call_result")
+INSERT_SQL = (f"INSERT INTO alerts ({', '.join(ALERT_COLS)}) "
+              f"VALUES ({', '.join('?' * len(ALERT_COLS))})")
+
+# One long‑lived connection: WAL + synchronous=NORMAL avoids an fsync per
+# insert, and every gunicorn worker/thread sees the same alerts.
+_DB      = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+_DB_LOCK = threading.Lock()
+_DB.row_factory = sqlite3.Row    # rows index by column name, no dict per row
+_DB.execute("PRAGMA journal_mode=WAL")
+_DB.execute("PRAGMA synchronous=NORMAL")
+_DB.execute("PRAGMA temp_store=MEMORY")
+_DB.execute("""CREATE TABLE IF NOT EXISTS alerts (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    symbol      TEXT,
+    time        TEXT,
+    ltp         TEXT,
+    move        REAL,
+    ce_chg      REAL,
+    pe_chg      REAL,
+    put_result  TEXT,
+    call_result TEXT)""")
+# Day = first 10 chars of time; the index also carries rowid, so
+# "WHERE day ORDER BY id" needs no sort step.
+_DB.execute("DROP INDEX IF EXISTS idx_alerts_time")
+_DB.execute("CREATE INDEX IF NOT EXISTS idx_alerts_day ON alerts(substr(time, 1, 10))")
+
+if ALERTS_FILE.exists():          # one‑time import of the old alerts.json
+    with _DB_LOCK:
+        _DB.execute("BEGIN IMMEDIATE")          # serialise racing workers
+        if not _DB.execute("SELECT 1 FROM alerts LIMIT 1").fetchone():
+            _DB.executemany(INSERT_SQL, [tuple(a.get(c) for c in ALERT_COLS)
+                                         for a in json.loads(ALERTS_FILE.read_text())])
+        _DB.execute("COMMIT")
+
+# Webhooks only enqueue; a background thread writes bursts in one transaction.
+_ALERT_Q = queue.Queue()
 
 def save_alert(row: dict):
-    db = json.loads(ALERTS_FILE.read_text()) if ALERTS_FILE.exists() else []
-    db.append(row)
-    ALERTS_FILE.write_text(json.dumps(db, indent=2))
-    alerts.append(row)
+    _ALERT_Q.put(tuple(row[c] for c in ALERT_COLS))
+
+def _flush_alerts(rows: list[tuple]):
+    with _DB_LOCK:
+        _DB.execute("BEGIN")
+        try:
+            _DB.executemany(INSERT_SQL, rows)
+            _DB.execute("COMMIT")
+        except Exception:
+            if _DB.in_transaction:
+                _DB.execute("ROLLBACK")
+            raise
+
+def _alert_flusher():
+    """Drain up to ALERT_BATCH rows or ALERT_FLUSH seconds, then write."""
+    while True:
+        rows     = [_ALERT_Q.get()]
+        deadline = time.monotonic() + ALERT_FLUSH
+        while len(rows) < ALERT_BATCH:
+            try:
+                rows.append(_ALERT_Q.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            _flush_alerts(rows)
+        except Exception:
+            logging.exception("Alert flush failed (%d rows)", len(rows))
+
+@atexit.register
+def _drain_alerts():
+    rows = []
+    while not _ALERT_Q.empty():
+        rows.append(_ALERT_Q.get_nowait())
+    if rows:
+        _flush_alerts(rows)
+
+threading.Thread(target=_alert_flusher, daemon=True).start()
+
+def load_alerts_for(day: str):
+    """All alerts stored for *day* (YYYY‑MM‑DD), oldest first."""
+    with _DB_LOCK:                    # equality seek on idx_alerts_day
+        cur = _DB.execute(f"SELECT {', '.join(ALERT_COLS)} FROM alerts "
+                          "WHERE substr(time, 1, 10) = ? ORDER BY id", (day,))
+        return cur.fetchall()
 
 # ─── Flask routes ─────────────────────────────────────────
 @app.route("/")
 def index():
     if not session.get("logged_in"):
         return redirect(url_for("login_page"))
-    return render_template("index.html", alerts=alerts, kite_api_key=KITE_API_KEY)
+    return render_template("index.html", alerts=load_alerts_for(today_str()),
+                           kite_api_key=KITE_API_KEY)
 
 @app.route("/login", methods=["GET", "POST"])
 def login_page():
@@ -221,10 +480,134 @@ def kite_callback():
         return "No request_token", 400
     kite = KiteConnect(api_key=KITE_API_KEY)
     data = kite.generate_session(rt, api_secret=KITE_API_SECRET)
-    TOKEN_FILE.write_text(data["access_token"])
+    tmp  = TOKEN_FILE.with_suffix(".tmp")      # atomic swap: readers never
+    tmp.write_text(data["access_token"])       # see a half‑written token
+    os.replace(tmp, TOKEN_FILE)
+    threading.Thread(target=_warm_instruments, kwargs={"force": True},
+                     daemon=True).start()
     return redirect(url_for("index"))
 
+# ─── Webhook workers ──────────────────────────────────────
+# The route only enqueues; the dispatcher and pool do the Kite/SQLite/Telegram
+# work so TradingView gets its 200 immediately and a slow alert never holds a
+# worker.
+_WEBHOOK_Q = queue.Queue(maxsize=1024)
+
+def process_alert(symbol: str):
+    """Build, store and notify the alert for *symbol*."""
+    kite = kite_session()
+
+    # Spot data – one quote() carries both LTP and previous close
+    spot_q     = spot_quote(kite, symbol)
+    ltp        = spot_q["last_price"]
+    prev_close = spot_q["ohlc"]["close"]
+    move_pct   = (ltp - prev_close) / prev_close * 100
+
+    # ΔCE / ΔPE (reuses the spot fetched above)
+    d_ce, d_pe = compute_ce_pe_change(kite, symbol, ltp)
+
+    # Option‑chain window
+    exp_dt  = next_expiry(symbol.upper())
+    strikes = chain_strikes(symbol.upper(), exp_dt)
+    atm     = atm_strike(strikes, ltp)
+    window  = strikes_window(strikes, atm, WIDTH_VOL)
+
+    if window:
+        # PUT/CALL per strike, candles fetched concurrently
+        jobs  = [(option_symbol(symbol, st, exp_dt, kind), kind == "PUT")
+                 for st in window for kind in ("PUT", "CALL")]
+        res   = list(_HIST_POOL.map(_check_leg, jobs))
+        puts  = [f"{st}{r}" for st, r in zip(window, res[0::2])]
+        calls = [f"{st}{r}" for st, r in zip(window, res[1::2])]
+        put_result  = "  ".join(puts)
+        call_result = "  ".join(calls)
+    else:
+        put_result = call_result = "No option chain"
+
+    # Persist & notify
+    alert = {
+        "symbol": symbol.upper(),
+        "time":   datetime.datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S"),
+        "ltp":    f"₹{ltp:.2f}",
+        "move":   move_pct,
+        "ce_chg": d_ce,
+        "pe_chg": d_pe,
+        "put_result":  put_result,
+        "call_result": call_result,
+    }
+    save_alert(alert)
+
+    # Always send – via the Telegram pool, send_telegram() logs failures
+    _TG_POOL.submit(
+        send_telegram,
+        f"*Option Screener Alert* 📊\n"
+        f"Symbol : `{alert['symbol']}`\n"
+        f"Time   : {alert['time']}\n"
+        f"LTP    : {alert['ltp']}  (Move {move_pct:.2f}%)\n"
+        f"ΔCE    : {d_ce:+.2f} | ΔPE {d_pe:+.2f}\n"
+        f"PUTs   : {put_result}\n"
+        f"CALLs  : {call_result}"
+    )
+
+_WEBHOOK_POOL = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+# At most WEBHOOK_WORKERS alerts in flight; the dispatcher blocks beyond that,
+# so _WEBHOOK_Q fills up and webhook() can answer 503.
+_WEBHOOK_SLOTS = threading.BoundedSemaphore(WEBHOOK_WORKERS)
+
+def _process_logged(symbol: str):
+    global _REJECTED_TOKEN
+    try:
+        process_alert(symbol)
+    except TokenException:
+        used = getattr(_KITE_LOCAL, "token", None)   # not TOKEN_FILE: a login may
+        if used != _REJECTED_TOKEN:                   # have replaced it meanwhile
+            _REJECTED_TOKEN = used                    # log once per bad token
+            logging.error("Kite rejected the access token (%s) – log in again", symbol)
+    except Exception:
+        logging.exception("Webhook error for %s", symbol)
+    finally:
+        _WEBHOOK_SLOTS.release()
+
+def _webhook_dispatcher():
+    """Collect up to WEBHOOK_BATCH alerts or WEBHOOK_WAIT seconds, then fan
+    them out to the pool as slots free up. Spot quotes are prefetched in one
+    kite.quote() only for the alerts that start right away, so the prefetch
+    is still within QUOTE_TTL when process_alert() reads it."""
+    while True:
+        batch    = [_WEBHOOK_Q.get()]
+        deadline = time.monotonic() + WEBHOOK_WAIT
+        while len(batch) < WEBHOOK_BATCH:
+            try:
+                batch.append(_WEBHOOK_Q.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:                          # this thread must never die
+            _dispatch(batch)
+        except Exception:
+            logging.exception("Webhook dispatch failed for %s", batch)
+
+def _dispatch(batch: list[str]):
+    while batch:
+        if token_rejected():          # no Kite calls until a fresh login
+            logging.warning("Dropping %s: access token rejected, log in again", batch)
+            return
+        _WEBHOOK_SLOTS.acquire()
+        n = 1
+        while n < len(batch) and _WEBHOOK_SLOTS.acquire(blocking=False):
+            n += 1
+        ready, batch = batch[:n], batch[n:]
+        try:                          # lands in _QUOTE_CACHE for process_alert()
+            quotes(kite_session(), sorted({f"NSE:{s.upper()}" for s in ready}))
+        except Exception:
+            logging.warning("Spot prefetch failed for %s", ready)
+        for symbol in ready:
+            _WEBHOOK_POOL.submit(_process_logged, symbol)
+
+threading.Thread(target=_webhook_dispatcher, daemon=True).start()
+
 # ─── Webhook endpoint ─────────────────────────────────────
+_SEEN, _SEEN_LOCK = {}, threading.Lock()   # symbol → last accepted bucket
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
     payload = request.get_json(force=True, silent=True) or {}
@@ -232,65 +615,24 @@ def webhook():
     if not symbol:
         return "symbol missing", 400
 
-    kite = kite_session()
-    try:
-        # ΔCE / ΔPE
-        d_ce, d_pe = compute_ce_pe_change(kite, symbol)
-
-        # Spot data
-        ltp        = kite.ltp([f"NSE:{symbol.upper()}"])[f"NSE:{symbol.upper()}"]["last_price"]
-        prev_close = kite.quote([f"NSE:{symbol.upper()}"])[f"NSE:{symbol.upper()}"]["ohlc"]["close"]
-        move_pct   = round((ltp - prev_close) / prev_close * 100, 2)
-
-        # Option‑chain window
-        exp_dt  = next_expiry(symbol.upper())
-        chain   = [i for i in instruments()
-                   if i["name"] == symbol.upper() and i["expiry"] == exp_dt]
-        strikes = sorted({i["strike"] for i in chain})
-        atm     = min(strikes, key=lambda x: abs(x - ltp))
-        window  = strikes_window(strikes, atm, WIDTH_VOL)
-
-        if window:
-            puts, calls = [], []
-            for st in window:
-                pe_ts = option_symbol(symbol, st, exp_dt, "PUT")
-                ce_ts = option_symbol(symbol, st, exp_dt, "CALL")
-                puts.append (f"{st}{check_option(pe_ts,  True)}")
-                calls.append(f"{st}{check_option(ce_ts, False)}")
-            put_result  = "  ".join(puts)
-            call_result = "  ".join(calls)
-        else:
-            put_result = call_result = "No option chain"
-
-        # Persist & notify
-        alert = {
-            "symbol": symbol.upper(),
-            "time":   datetime.datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S"),
-            "ltp":    f"₹{ltp:.2f}",
-            "move":   move_pct,
-            "ce_chg": d_ce,
-            "pe_chg": d_pe,
-            "put_result":  put_result,
-            "call_result": call_result,
-        }
-        save_alert(alert)
-
-        # Always send
-        send_telegram(
-            f"*Option Screener Alert* 📊\n"
-            f"Symbol : `{alert['symbol']}`\n"
-            f"Time   : {alert['time']}\n"
-            f"LTP    : {alert['ltp']}  (Move {alert['move']}%)\n"
-            f"ΔCE    : {d_ce:+} | ΔPE {d_pe:+}\n"
-            f"PUTs   : {put_result}\n"
-            f"CALLs  : {call_result}"
-        )
-        return "OK", 200
-
-    except Exception:
-        logging.exception("Webhook error")
-        return "Error", 500
+    key, bucket = symbol.upper(), int(time.time() // DEDUP_SECS)
+    with _SEEN_LOCK:              # TradingView often fires the same alert twice
+        if _SEEN.get(key) == bucket:
+            return "Duplicate", 200
+        try:
+            _WEBHOOK_Q.put_nowait(symbol)
+        except queue.Full:
+            logging.warning("Webhook queue full, dropping %s", symbol)
+            return "Busy", 503
+        _SEEN[key] = bucket
+    return "OK", 200
+
+# ─── Instrument warm‑up ───────────────────────────────────
+_schedule_warmup()
+if access_token():
+    threading.Thread(target=_warm_instruments, daemon=True).start()
 
 # ─── Local dev runner ─────────────────────────────────────
+# Production runs under gunicorn (see Procfile); this is for local use only.
 if __name__ == "__main__":
-    app.run(debug=True, port=int(os.getenv("PORT", 10000)))
+    app.run(threaded=True, port=int(os.getenv("PORT", 10000)))
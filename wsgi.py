@@ -0,0 +1,7 @@
+# wsgi.py – gunicorn entry point (gevent workers)
+# Patch sockets/threads *before* app.py imports requests and kiteconnect so
+# blocking Kite/Telegram HTTPS calls yield to other greenlets.
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402